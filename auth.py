@@ -2,13 +2,18 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, Row
 
 
 from passlib.context import CryptContext
-from jose import jwt, JWTError
+from jose import JWTError
 from datetime import timedelta, datetime, timezone
 import secrets
+import base64
+import hashlib
+import hmac
+import time
+import orjson
 from dotenv import load_dotenv
 
 from database import get_db
@@ -16,7 +21,36 @@ from models import User
 import os
 
 load_dotenv()
-pwd_context = CryptContext(schemes=['sha256_crypt'], deprecated='auto')
+pwd_context = CryptContext(
+    schemes=['argon2', 'bcrypt', 'pbkdf2_sha512', 'sha256_crypt'],
+    default='argon2',
+    deprecated='auto')
+
+DUMMY_HASH = pwd_context.hash('x')
+
+TOKEN_CACHE_MAXSIZE = 10_000
+_token_cache: dict[bytes, tuple[float, int, str]] = {}
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+def _token_cache_get(key: bytes) -> tuple[float, int, str] | None:
+    entry = _token_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.time():
+        _token_cache.pop(key, None)
+        return None
+    return entry
+
+def _token_cache_put(key: bytes, exp: float, user_id: int, username: str) -> None:
+    if len(_token_cache) >= TOKEN_CACHE_MAXSIZE:
+        now = time.time()
+        for k in [k for k, v in _token_cache.items() if v[0] <= now]:
+            del _token_cache[k]
+        if len(_token_cache) >= TOKEN_CACHE_MAXSIZE:
+            _token_cache.clear()
+    _token_cache[key] = (exp, user_id, username)
 
 SECRET_KEY = os.getenv('SECRET_KEY')
 ALGORITHM = 'HS256'
@@ -24,6 +58,77 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 1440
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='token')
 
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+_HEADER_B64 = _b64url(orjson.dumps({'alg': ALGORITHM, 'typ': 'JWT'}))
+
+if not SECRET_KEY:
+    raise RuntimeError('SECRET_KEY is not set')
+
+_SECRET_BYTES = SECRET_KEY.encode('utf-8')
+_HMAC_TEMPLATE = hmac.new(_SECRET_BYTES, digestmod='sha256')
+
+def _sign_hs256(signing_input: bytes) -> bytes:
+    h = _HMAC_TEMPLATE.copy()
+    h.update(signing_input)
+    return h.digest()
+
+def verify_hs256_signature(signing_input: bytes, signature: bytes) -> bool:
+    return hmac.compare_digest(_sign_hs256(signing_input), signature)
+
+def fast_encode_hs256(payload: dict) -> str:
+    signing_input = _HEADER_B64 + b'.' + _b64url(orjson.dumps(payload))
+    return (signing_input + b'.' + _b64url(_sign_hs256(signing_input))).decode('ascii')
+
+def _decode_verified(token: str) -> dict:
+    try:
+        signing_input, _, sig_b64 = token.encode('ascii').rpartition(b'.')
+    except UnicodeEncodeError:
+        raise JWTError('Invalid token')
+
+    if signing_input.count(b'.') != 1:
+        raise JWTError('Not enough segments')
+
+    try:
+        signature = base64.urlsafe_b64decode(sig_b64 + b'=' * (-len(sig_b64) % 4))
+    except ValueError:
+        raise JWTError('Invalid signature encoding')
+
+    if not verify_hs256_signature(signing_input, signature):
+        raise JWTError('Signature verification failed')
+
+    payload_b64 = signing_input.split(b'.', 1)[1]
+    try:
+        payload = orjson.loads(base64.urlsafe_b64decode(payload_b64 + b'=' * (-len(payload_b64) % 4)))
+    except ValueError:
+        raise JWTError('Invalid payload')
+
+    if not isinstance(payload, dict):
+        raise JWTError('Invalid payload')
+    return payload
+
+PAYLOAD_CACHE_MAXSIZE = 4096
+_payload_cache: dict[bytes, dict] = {}
+
+def _verify_and_parse(token: str) -> dict:
+    key = _token_cache_key(token)
+    payload = _payload_cache.get(key)
+    if payload is None:
+        payload = _decode_verified(token)
+        if len(_payload_cache) >= PAYLOAD_CACHE_MAXSIZE:
+            now = time.time()
+            for k in [k for k, v in _payload_cache.items() if v.get('exp', 0) <= now]:
+                del _payload_cache[k]
+            if len(_payload_cache) >= PAYLOAD_CACHE_MAXSIZE:
+                _payload_cache.clear()
+        _payload_cache[key] = payload
+
+    if payload.get('exp', 0) <= time.time():
+        _payload_cache.pop(key, None)
+        raise JWTError('Signature has expired')
+    return payload
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     verified = pwd_context.verify(plain_password, hashed_password)
     return verified
@@ -32,60 +137,97 @@ def hash_password(password: str) -> str:
     hashed = pwd_context.hash(password)
     return hashed
 
+def password_needs_update(hashed_password: str) -> bool:
+    return pwd_context.needs_update(hashed_password)
+
 
 def create_token(data: dict, expires_delta: timedelta | None = None) -> str:
-    
+
     if not expires_delta:
-        time = datetime.now(timezone.utc) + timedelta(ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     else:
-        time = datetime.now(timezone.utc) + expires_delta
+        expire = datetime.now(timezone.utc) + expires_delta
 
-    data['exp'] = time
-    token = jwt.encode(claims=data, key=SECRET_KEY, algorithm=ALGORITHM)
+    data['exp'] = int(expire.timestamp())
+    token = fast_encode_hs256(data)
     return token
 
-async def decode_token(token: str, db = AsyncSession) -> User:
+async def decode_token(token: str, db: AsyncSession) -> Row:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},)
+
+    cache_key = _token_cache_key(token)
+    cached = _token_cache_get(cache_key)
+    if cached is not None:
+        result = await db.execute(
+            select(User.id, User.username).where(User.id == cached[1], User.is_active == True))
+        user = result.first()
+        if user is None:
+            raise credentials_exception
+        return user
+
     try:
-        payload = jwt.decode(token=token, key=SECRET_KEY, algorithms=ALGORITHM)
+        payload = _verify_and_parse(token)
 
         username: str = payload.get('username')
         if username is None:
             raise credentials_exception
-    
+
     except JWTError:
         raise credentials_exception
-    
-    user = await db.execute(select(User).filter_by(username=username, is_active=True))
-    user = user.scalar_one_or_none()
+
+    result = await db.execute(
+        select(User.id, User.username).where(User.username == username, User.is_active == True))
+    user = result.first()
 
     if user is None:
         raise credentials_exception
+
+    exp = payload.get('exp')
+    if exp:
+        _token_cache_put(cache_key, exp, user.id, user.username)
     return user
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> User:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Row:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
         )
+
+    cache_key = _token_cache_key(token)
+    cached = _token_cache_get(cache_key)
+    if cached is not None:
+        result = await db.execute(
+            select(User.id, User.username, User.is_active, User.created_at)
+            .where(User.id == cached[1], User.is_active == True))
+        user = result.first()
+        if user is None:
+            raise credentials_exception
+        return user
+
     try:
-        payload = jwt.decode(token=token, algorithms=ALGORITHM, key=SECRET_KEY)
+        payload = _verify_and_parse(token)
         username: str = payload.get('username')
-        
+
         if username is None:
             raise credentials_exception
-    
+
     except JWTError:
         raise credentials_exception
-    
-    user_result = await db.execute(select(User).filter_by(username=username, is_active=True))
-    user = user_result.scalar_one_or_none()
+
+    result = await db.execute(
+        select(User.id, User.username, User.is_active, User.created_at)
+        .where(User.username == username, User.is_active == True))
+    user = result.first()
     if not user:
-        raise credentials_exception 
+        raise credentials_exception
+
+    exp = payload.get('exp')
+    if exp:
+        _token_cache_put(cache_key, exp, user.id, user.username)
     return user
 
 
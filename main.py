@@ -2,150 +2,235 @@ from fastapi import Depends, HTTPException, status, FastAPI, WebSocket, WebSocke
 from fastapi.security import OAuth2PasswordRequestForm
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update, Row
 
 from models import User, Message
-from database import engine, Base, get_db
+from database import engine, Base, get_db, AsyncSessionLocal
 from schemas import UserCreate, Token, UserResponse
-from auth import hash_password, verify_password, create_token, get_current_user, decode_token
-import json
+from auth import hash_password, verify_password, password_needs_update, create_token, get_current_user, decode_token, DUMMY_HASH
+import asyncio
+import logging
+import logging.handlers
+import queue
+import orjson
 
 app = FastAPI()
 
+logger = logging.getLogger('chat')
+
+def setup_logging() -> logging.handlers.QueueListener:
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
+ERR_BAD_JSON = orjson.dumps({'status': 'error', 'message': 'Неверный JSON'})
+ERR_MISSING_FIELDS = orjson.dumps({'status': 'error', 'message': 'Отсутствует необходимая информация в json'})
+
+MESSAGE_BATCH_SIZE = 500
+MESSAGE_FLUSH_INTERVAL = 0.05
+message_queue: asyncio.Queue[dict] = asyncio.Queue()
+
+async def message_writer() -> None:
+    while True:
+        batch = [await message_queue.get()]
+        while len(batch) < MESSAGE_BATCH_SIZE:
+            try:
+                batch.append(message_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(insert(Message), batch)
+                await db.commit()
+        except Exception as e:
+            logger.error('Ошибка при сохранении сообщений %s', e)
+
+        await asyncio.sleep(MESSAGE_FLUSH_INTERVAL)
+
 class ConnectionManager:
     def __init__(self):
-        self.websockets: dict[str, dict[WebSocket, str]] = {}
+        self.rooms: dict[str, set[WebSocket]] = {}
+        self.ws_info: dict[WebSocket, tuple[str, str]] = {}
         self.usernames_to_websockets: dict[str, WebSocket] = {}
-    
+        self.room_members: dict[str, set[str]] = {}
+
     async def connect(self, websocket: WebSocket, username: str, room: str):
         await websocket.accept()
-        
-        if not room in self.websockets:
-            self.websockets[room] = {}
-        
-        self.websockets[room][websocket] = username
+
+        self.rooms.setdefault(room, set()).add(websocket)
+        self.ws_info[websocket] = (username, room)
         self.usernames_to_websockets[username] = websocket
-    
+        self.room_members.setdefault(room, set()).add(username)
+
     async def disconnect(self, websocket: WebSocket, room: str):
-        if room in self.websockets and websocket in self.websockets[room]:
-            username = self.websockets[room].pop(websocket)
-            
-            if username in self.usernames_to_websockets:
-                del self.usernames_to_websockets[username]
-        
-            if not self.websockets[room]:
-                del self.websockets[room]
-    
-    async def send_private_message(self, message: str, recipient: str, sender: str, room: str):
-        if not room in self.websockets:
-            print('Указаная комната не существует')
+        info = self.ws_info.pop(websocket, None)
+        if info is None:
+            return
+        username, room = info
+
+        if room in self.rooms:
+            self.rooms[room].discard(websocket)
+            if not self.rooms[room]:
+                del self.rooms[room]
+
+        if room in self.room_members:
+            self.room_members[room].discard(username)
+            if not self.room_members[room]:
+                del self.room_members[room]
+
+        self.usernames_to_websockets.pop(username, None)
+
+    async def send_private_message(self, message: bytes, recipient: str, sender: str, room: str):
+        if not room in self.rooms:
+            logger.warning('Указаная комната не существует')
             return (None, 'Указаная комната не существует')
-        
-        if not recipient in self.websockets[room].values() or not sender in self.websockets[room].values():
-            print('Отправитель и получатель должны находится в одной комнате для отправки сообщений')
+
+        members = self.room_members.get(room, set())
+        if not recipient in members or not sender in members:
+            logger.warning('Отправитель и получатель должны находится в одной комнате для отправки сообщений')
             return (None, 'Отправитель и получатель должны находится в одной комнате для отправки сообщений')
 
         websocket = self.usernames_to_websockets.get(recipient)
         if websocket:
             try:
-                await websocket.send_text(message)
-                
+                await websocket.send_bytes(message)
+
             except RuntimeError as e:
-                print(f'Ошибка при отправке сообщения (возможно не в сети) {e}')
+                logger.warning('Ошибка при отправке сообщения (возможно не в сети) %s', e)
                 await self.disconnect(websocket, room)
                 return (None, 'Пользователь не в сети')
 
             except Exception as e:
-                print(f'Ошибка при отправке сообщения {e}')
+                logger.warning('Ошибка при отправке сообщения %s', e)
                 await self.disconnect(websocket, room)
                 return (None, 'Ошибка при отправке сообщения')
         else:
-            print(f'Сообщение не отправлено, получатель {recipient} не найден или не в сети!')
+            logger.warning('Сообщение не отправлено, получатель %s не найден или не в сети!', recipient)
             return (None, f'Сообщение не отправлено, получатель {recipient} не найден или не в сети!')
         return (True, "Сообщение успешно отправлено")
     
-    async def broadcast(self, message: str, room: str):
-        if not room in self.websockets:
-            print('Указаная комната не существует')
+    async def broadcast_bytes(self, message: bytes, room: str):
+        if not room in self.rooms:
+            logger.warning('Указаная комната не существует')
             return (None, 'Указаная комната не существует')
-        
-        for socket in list(self.websockets[room].keys()):
-            try:
-                await socket.send_text(message)
 
-            except RuntimeError as e:
-                print(f'Ошибка при отправке сообщения (возможно отключился) {e}')
-                await self.disconnect(socket, room)
-                return (None, f'Ошибка при отправке сообщения (возможно отключился) {e}')
+        frame = {'type': 'websocket.send', 'bytes': message}
+        sockets = list(self.rooms[room])
+        results = await asyncio.gather(*(socket.send(frame) for socket in sockets), return_exceptions=True)
+
+        failed = [(socket, result) for socket, result in zip(sockets, results) if isinstance(result, Exception)]
+        for socket, result in failed:
+            logger.warning('Ошибка при отправке сообщения (возможно отключился) %s', result)
+            await self.disconnect(socket, room)
 
-            except Exception as e:
-                print(f'Ошибка при отправке сообщения {e}')
-                await self.disconnect(socket, room)
-                return (None, f'Ошибка при отправке сообщения (возможно отключился) {e}')
         return (True, "Сообщение успешно отправлено")
 
 manager = ConnectionManager()
 
 @app.websocket('/ws/{room}')
-async def websocket(websocket: WebSocket, room: str, db: AsyncSession = Depends(get_db)):
+async def websocket(websocket: WebSocket, room: str):
     header = websocket.headers.get('Authorization')
     if not header or not header.lower().startswith('bearer '):
         await websocket.close(
             code=status.WS_1008_POLICY_VIOLATION,
             reason="Authentication token required or malformed")
         return
-    
+
     token_value = header.split(' ', 1)[1]
-    
+
     try:
-        user = await decode_token(token_value, db)
+        async with AsyncSessionLocal() as db:
+            user = await decode_token(token_value, db)
     except HTTPException as e:
         await websocket.close(
             code=status.WS_1008_POLICY_VIOLATION,
             reason=f"Authentication failed: {e.detail}"
         )
-        print(f"WebSocket: Отклонено - ошибка аутентификации: {e.detail}")
+        logger.warning('WebSocket: Отклонено - ошибка аутентификации: %s', e.detail)
         return 
 
     await manager.connect(websocket, user.username, room=room)
-    
+
+    prefix = f'Пользователь {user.username}: '.encode('utf-8')
+
     try:
         while True:
             try:
                 json_data = await websocket.receive_text()
-                message = json.loads(json_data)
-                completed_message = f'Пользователь {user.username}: {message['data']}'
-                
+                message = orjson.loads(json_data)
+                data_text = str(message['data'])
+                completed_message = prefix + data_text.encode('utf-8')
+
                 if message['type'] == 'broadcast':
-                    success = await manager.broadcast(completed_message, room)
+                    success = await manager.broadcast_bytes(completed_message, room)
                     if not success[0]:
-                        await websocket.send_text(json.dumps({'status': 'error', 'message': success[1]}))
-                
+                        await websocket.send_bytes(orjson.dumps({'status': 'error', 'message': success[1]}))
+                    else:
+                        message_queue.put_nowait({'room': room, 'sender': user.username, 'message': data_text})
+
                 elif message['type'] == 'private':
                     success = await manager.send_private_message(completed_message, message['recipient'], user.username, room=room)
                     if not success[0]:
-                        await websocket.send_text(json.dumps({'status': 'error', 'message': success[1]}))
-                    
-            
-            except json.JSONDecodeError as e:
-                print(f'Неверная информация в json {e}')
-                await websocket.send_text(json.dumps({'status': 'error', 'message': f'Неверный JSON: {e}'}))
-                continue 
-            
+                        await websocket.send_bytes(orjson.dumps({'status': 'error', 'message': success[1]}))
+                    else:
+                        message_queue.put_nowait({'room': room, 'sender': user.username, 'message': data_text})
+
+
+            except orjson.JSONDecodeError as e:
+                logger.warning('Неверная информация в json %s', e)
+                await websocket.send_bytes(ERR_BAD_JSON)
+                continue
+
             except KeyError as e:
-                print(f'Отсутствует необходимая информация в json {e}')
-                await websocket.send_text(json.dumps({'status': 'error', 'message': f'Отсутствует необходимая информация в json {e}'}))
+                logger.warning('Отсутствует необходимая информация в json %s', e)
+                await websocket.send_bytes(ERR_MISSING_FIELDS)
                 continue
 
     except WebSocketDisconnect as e:
         await manager.disconnect(websocket=websocket, room=room)
-        print(f'Пользователь вышел {e}')
+        logger.info('Пользователь вышел %s', e)
     
 @app.on_event("startup")
 async def startup() -> None:
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
+    app.state.log_listener = setup_logging()
+    app.state.message_writer_task = asyncio.create_task(message_writer())
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    task = getattr(app.state, 'message_writer_task', None)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    batch = []
+    while True:
+        try:
+            batch.append(message_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+
+    if batch:
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(insert(Message), batch)
+                await db.commit()
+        except Exception as e:
+            logger.error('Ошибка при сохранении сообщений %s', e)
+
+    listener = getattr(app.state, 'log_listener', None)
+    if listener is not None:
+        listener.stop()
+
 @app.post('/register', response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 async def user_create(user_data: UserCreate, db: AsyncSession = Depends(get_db)) -> User:
     
@@ -166,16 +251,29 @@ async def user_create(user_data: UserCreate, db: AsyncSession = Depends(get_db))
 @app.post('/token', response_model=Token)
 async def get_token(form_data: OAuth2PasswordRequestForm = Depends() ,db: AsyncSession = Depends(get_db)) -> Token:
     
-    user = await db.execute(select(User).filter_by(username=form_data.username))
-    user = user.scalar_one_or_none()
+    result = await db.execute(
+        select(User.id, User.username, User.hashed_password).where(User.username == form_data.username))
+    user = result.first()
 
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    hashed = user.hashed_password if user else DUMMY_HASH
+    verified = verify_password(form_data.password, hashed)
+    if not user or not verified:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
-    
+
+    if password_needs_update(user.hashed_password):
+        await db.execute(update(User).where(User.id == user.id).values(hashed_password=hash_password(form_data.password)))
+        await db.commit()
+
     new_token = create_token(data={'username': user.username})
     token = Token(access_token=new_token)
     return token
 
 @app.get('/users/me', response_model=UserResponse)
-async def get_user(current_user: User = Depends(get_current_user)) -> User:
-    return current_user
\ No newline at end of file
+async def get_user(current_user: Row = Depends(get_current_user)) -> Row:
+    return current_user
+
+if __name__ == '__main__':
+    import uvicorn
+    import uvloop
+    uvloop.install()
+    uvicorn.run('main:app', loop='uvloop', http='httptools')
\ No newline at end of file
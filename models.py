@@ -1,5 +1,5 @@
-from sqlalchemy import Column, String, Integer, DateTime, Boolean
-from datetime import datetime, timezone
+from sqlalchemy import Column, String, Integer, DateTime, Boolean, Index, text
+from sqlalchemy.sql import func
 from database import Base
 
 class Message(Base):
@@ -8,7 +8,7 @@ class Message(Base):
     room = Column(String, index=True)
     sender = Column(String, index=True)
     message = Column(String)
-    created_at = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
 class User(Base):
     __tablename__ = 'users'
@@ -16,7 +16,11 @@ class User(Base):
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_users_username_active', 'username', postgresql_where=text('is_active = true')),
+    )
     
 
 